@@ -0,0 +1,223 @@
+import argparse
+import multiprocessing
+import os
+import pathlib
+import resource
+import sys
+import tempfile
+import time
+
+import gym
+import numpy as np
+
+sys.path.append(str(pathlib.Path(__file__).parent))
+
+import tools
+import wrappers
+
+
+def measure(fn, amount):
+  fn()  # Warm up.
+  start = time.time()
+  for _ in range(amount):
+    fn()
+  return amount / (time.time() - start)
+
+
+def fake_episodes(directory, episodes, length, size=64):
+  random = np.random.RandomState(0)
+  for index in range(episodes):
+    tools.save_episodes(directory, [{
+        'image': random.randint(0, 255, (length, size, size, 3), np.uint8),
+        'action': random.uniform(-1, 1, (length, 6)).astype(np.float32),
+        'reward': random.uniform(0, 1, length).astype(np.float32),
+        'discount': np.ones(length, np.float32),
+        'success': np.zeros(length, np.float32),
+        'real_world': np.full(length, float(index % 10 == 0), np.float32),
+    }])
+
+
+def sampler(args):
+  # Batches per second of the per-segment generator followed by batching, as
+  # the dataset used to be built, against the vectorized batch sampler.
+  with tempfile.TemporaryDirectory() as directory:
+    fake_episodes(directory, args.episodes, args.episode_length)
+    replay = tools.Replay(directory, transforms=[tools.broadcast_success])
+    generator = tools.load_episodes(
+        replay, args.batch_size, args.batch_length, real_world_prob=0.1)
+    def generator_batch():
+      segments = [next(generator) for _ in range(args.batch_size)]
+      return {k: np.stack([s[k] for s in segments]) for k in segments[0]}
+    batch_sampler = tools.BatchSampler(
+        replay, args.batch_size, args.batch_length, real_world_prob=0.1)
+    print('generator', f'{measure(generator_batch, args.amount):.1f}', 'batches/sec')
+    print('sampler  ', f'{measure(batch_sampler, args.amount):.1f}', 'batches/sec')
+
+
+class StateEnv:
+
+  # Cheap state-only control env, so that the wrappers dominate a step.
+
+  def __init__(self, length=1000):
+    self._length = length
+    self._step = 0
+
+  @property
+  def observation_space(self):
+    space = gym.spaces.Box(-np.inf, np.inf, (8,), dtype=np.float32)
+    return gym.spaces.Dict({'state': space})
+
+  @property
+  def action_space(self):
+    return gym.spaces.Box(-2, 2, (6,), dtype=np.float32)
+
+  def step(self, action, render=True):
+    self._step += 1
+    obs = {'state': np.full(8, self._step, np.float32)}
+    return obs, 0.5, self._step >= self._length, {}
+
+  def reset(self):
+    self._step = 0
+    return {'state': np.zeros(8, np.float32)}
+
+  def render_obs(self, obs):
+    return obs
+
+
+def wrapper_stack(args):
+  # Env steps per second through the stack of wrappers that make_env used to
+  # build for control suites, against the fused wrapper.
+  repeat, duration = 2, 500
+  stacked = StateEnv()
+  stacked = wrappers.ActionRepeat(stacked, repeat)
+  stacked = wrappers.NormalizeActions(stacked)
+  stacked = wrappers.TimeLimit(stacked, duration)
+  stacked = wrappers.Collect(stacked, [lambda episode: None])
+  stacked = wrappers.RewardObs(stacked)
+  fused = wrappers.FusedControl(
+      StateEnv(), repeat, duration, [lambda episode: None])
+  action = np.linspace(-1, 1, 6).astype(np.float32)
+  def stepper(env):
+    env.reset()
+    def step():
+      if env.step(action)[2]:
+        env.reset()
+    return step
+  steps = args.amount * 100
+  print('stacked', f'{measure(stepper(stacked), steps):.0f}', 'steps/sec')
+  print('fused  ', f'{measure(stepper(fused), steps):.0f}', 'steps/sec')
+
+
+def scan(args):
+  # Trace time, train step time and peak host memory of a world model and
+  # imagination train step, with the loops over time unrolled when tracing
+  # or as graph loops. Every mode runs in a fresh process to measure memory.
+  context = multiprocessing.get_context('spawn')
+  for mode in ('unroll', 'graph'):
+    with context.Pool(1) as pool:
+      trace, step, memory = pool.apply(scan_mode, (mode, args))
+    print(
+        f'{mode:7}', f'trace {trace:.1f} sec', f'step {1000 * step:.1f} ms',
+        f'memory {memory / 1024:.0f} MB')
+
+
+def scan_mode(mode, args):
+  import tensorflow as tf
+  import models
+  tools.SCAN_MODE = mode
+  dynamics = models.RSSM(30, 200, 200)
+  actor = models.ActionDecoder(6, 4, 400)
+  value = models.DenseDecoder((), 3, 400)
+  optimizer = tf.optimizers.Adam(1e-4)
+  shape = [args.batch_size, args.batch_length]
+  embed = tf.random.normal(shape + [1024])
+  action = tf.random.uniform(shape + [6], -1, 1)
+  @tf.function
+  def train():
+    with tf.GradientTape() as tape:
+      post, prior = dynamics.observe(embed, action)
+      start = {k: tf.reshape(v, [-1, v.shape[-1]]) for k, v in post.items()}
+      policy = lambda state: actor(dynamics.get_feat(state)).sample()
+      states = tools.static_scan(
+          lambda prev, _: dynamics.img_step(prev, policy(prev)),
+          tf.range(args.horizon), start)
+      values = value(dynamics.get_feat(states)).mode()
+      returns = tools.lambda_return(
+          values[:-1], values[:-1], 0.99, bootstrap=values[-1], lambda_=0.95,
+          axis=0)
+      loss = -tf.reduce_mean(returns)
+    variables = dynamics.variables + actor.variables + value.variables
+    grads = tape.gradient(loss, variables)
+    optimizer.apply_gradients(zip(grads, variables))
+  start = time.time()
+  train()
+  trace = time.time() - start
+  step = 1 / measure(train, args.amount)
+  memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return trace, step, memory
+
+
+def jit(args):
+  # Train step and policy step times on CPU, for the debug and the default
+  # model sizes, without and with XLA. Every run uses a fresh process, which
+  # gets the XLA flags through its environment because they are read when
+  # TensorFlow is imported.
+  context = multiprocessing.get_context('spawn')
+  flags = os.environ.get('TF_XLA_FLAGS', '')
+  for sizes in ('debug', 'default'):
+    for enabled in (False, True):
+      os.environ['TF_XLA_FLAGS'] = (
+          flags + ' --tf_xla_cpu_global_jit' if enabled else flags).strip()
+      with context.Pool(1) as pool:
+        train, policy = pool.apply(jit_mode, (sizes, enabled, args))
+      print(
+          f'{sizes:7}', 'xla' if enabled else 'tf ',
+          f'train {1000 * train:.1f} ms', f'policy {1000 * policy:.1f} ms')
+  os.environ['TF_XLA_FLAGS'] = flags
+
+
+def jit_mode(sizes, enabled, args):
+  os.environ['CUDA_VISIBLE_DEVICES'] = ''
+  import dreamer
+  import tensorflow as tf
+  config = dreamer.define_config()
+  if sizes == 'debug':
+    config = dreamer.config_debug(config)
+  config.jit = enabled
+  if enabled:
+    tools.enable_jit()
+  with tempfile.TemporaryDirectory() as directory:
+    config.logdir = pathlib.Path(directory)
+    datadir = config.logdir / 'episodes'
+    datadir.mkdir()
+    fake_episodes(datadir, args.episodes, args.episode_length)
+    writer = tf.summary.create_file_writer(directory)
+    actspace = gym.spaces.Box(-1, 1, (6,), dtype=np.float32)
+    agent = dreamer.Dreamer(config, datadir, actspace, writer)
+    obs = {
+        'image': np.zeros((config.envs, 64, 64, 3), np.uint8),
+        'reward': np.zeros(config.envs, np.float32)}
+    train = measure(lambda: agent.train(next(agent._dataset)), args.amount)
+    policy = measure(lambda: agent.policy(obs, None, True), args.amount)
+  return 1 / train, 1 / policy
+
+
+BENCHMARKS = dict(
+    sampler=sampler, wrappers=wrapper_stack, scan=scan, jit=jit)
+
+
+def parse_args():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('benchmark', choices=list(BENCHMARKS.keys()))
+  parser.add_argument('--amount', type=int, default=100)
+  parser.add_argument('--episodes', type=int, default=50)
+  parser.add_argument('--episode_length', type=int, default=501)
+  parser.add_argument('--batch_size', type=int, default=50)
+  parser.add_argument('--batch_length', type=int, default=50)
+  parser.add_argument('--horizon', type=int, default=15)
+  return parser.parse_args()
+
+
+if __name__ == '__main__':
+  args = parse_args()
+  BENCHMARKS[args.benchmark](args)
@@ -1,16 +1,30 @@
 import argparse
 import collections
+import contextlib
 import functools
 import json
 import os
 import pathlib
 import sys
+import threading
 import time
 import shutil
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 os.environ['MUJOCO_GL'] = 'osmesa'
 
+
+def _flag_value(argv, name):
+  argv = [part for arg in argv for part in arg.split('=', 1)]
+  return argv[argv.index(name) + 1] if name in argv[:-1] else None
+
+
+# XLA reads its flags when TensorFlow is loaded, so the CPU auto-clustering flag
+# for --jit has to be set before the import.
+if _flag_value(sys.argv[1:], '--jit') == 'True':
+  os.environ['TF_XLA_FLAGS'] = (
+      os.environ.get('TF_XLA_FLAGS', '') + ' --tf_xla_cpu_global_jit').strip()
+
 import numpy as np
 import tensorflow as tf
 from tensorflow.keras.mixed_precision import experimental as prec
@@ -88,10 +102,15 @@ def define_config():
   config.log_images = True
   config.gpu_growth = True
   config.precision = 32
+  config.jit = False  # Compile with XLA where supported, see tools.enable_jit.
   # Environment.
   config.task = 'dmc_cup_catch'
   config.envs = 1
+  config.envs_per_worker = 1
   config.parallel = 'none'
+  config.async_transport = 'pipe'  # pipe or shm, for parallel process only.
+  config.fused_wrappers = True  # One flat wrapper for dmc and gym suites.
+  config.first_ready = False  # Act on workers as they finish, for parallel process only.
   config.action_repeat = 2
   config.time_limit = 1000
   config.prefill = 5000
@@ -105,6 +124,7 @@ def define_config():
   config.cnn_act = 'relu'
   config.cnn_depth = 32
   config.pcont = False
+  config.scan_mode = 'unroll'  # unroll or graph, how to loop over time steps.
   config.free_nats = 3.0
   config.kl_scale = 1.0
   config.pcont_scale = 10.0
@@ -116,11 +136,25 @@ def define_config():
   config.train_every = 1000
   config.train_steps = 100
   config.pretrain = 100
+  config.train_schedule = 'every'  # every, ratio or time.
+  config.train_fraction = 0.5  # Share of wall-clock time to train for the time schedule.
+  # Train in a background thread while the agent acts on a copy of the policy.
+  config.async_learner = False
+  config.train_ratio = 0.0  # Train steps per env step, 0 for train_steps / train_every.
+  config.max_staleness = 100  # Train steps the learner may lag behind the ratio.
+  config.policy_sync_every = 10  # Train steps between policy copies.
   config.model_lr = 6e-4
   config.value_lr = 8e-5
   config.actor_lr = 8e-5
   config.grad_clip = 100.0
   config.dataset_balance = False
+  config.loader_workers = 1
+  config.device_preprocess = False  # Prefetch uint8 images and normalize them in the train step.
+  config.replay_budget = 0  # Bytes of decoded episodes kept in memory, 0 for no limit.
+  config.replay_eviction = 'fifo'  # fifo, reservoir or keep_real.
+  config.episode_format = 'npz'  # npz or mmap.
+  config.replay_maps = 16384  # Memory maps of mmap episodes kept open.
+  config.episode_codec = 'zlib'  # none, zlib, zlib:LEVEL, lz4 or zstd, for npz only.
   # Behavior.
   config.discount = 0.99
   config.disclam = 0.95
@@ -133,6 +167,9 @@ def define_config():
   config.expl_min = 0.0
   config.id = 'debug'
   config.use_state = False
+  config.reset_pool = 0  # Start states to snapshot and restore on reset, 0 to disable.
+  config.state_only = False  # Learn from states without rendering, except for test videos.
+  config.keep_pixels = True  # Store the Fetch pixels key, a copy of the image.
 
   # Sim2real transfer
   config.real_world_prob = -1  # fraction of samples trained on which are from the real world (probably involves oversampling real-world samples)
@@ -180,6 +217,10 @@ def config_debug(config):
 
 class Dreamer(tools.Module):
 
+  # The policy copy is left out of the checkpoint, it is synced after loading.
+  _TF_MODULE_IGNORED_PROPERTIES = (
+      tools.Module._TF_MODULE_IGNORED_PROPERTIES | {'_policy_modules'})
+
   def __init__(self, config, datadir, actspace, writer):
     self._c = config
     self._actspace = actspace
@@ -190,57 +231,122 @@ class Dreamer(tools.Module):
       self._step = tf.Variable(count_steps(datadir, config), dtype=tf.int64)
     self._should_pretrain = tools.Once()
     self._should_train = tools.Every(config.train_every)
+    if config.train_schedule != 'every':
+      self._schedule = tools.TrainSchedule(
+          config.train_schedule,
+          config.train_ratio or config.train_steps / config.train_every,
+          config.train_fraction, config.train_steps)
     self._should_log = tools.Every(config.log_every)
     self._last_log = None
     self._last_time = time.time()
     self._metrics = collections.defaultdict(tf.metrics.Mean)
     self._metrics['expl_amount']  # Create variable for checkpoint.
     self._float = prec.global_policy().compute_dtype
+    self._lock = threading.Lock()  # Held by the learner thread per train step.
+    self._learner = None
+    self._updates = 0
     self._strategy = tf.distribute.MirroredStrategy()
+    self._replay = tools.Replay(
+        datadir, config.replay_budget, config.replay_eviction, config.seed,
+        transforms=[tools.broadcast_success], maps=config.replay_maps)
     with self._strategy.scope():
       self._dataset = iter(self._strategy.experimental_distribute_dataset(
-          load_dataset(datadir, self._c)))
+          load_dataset(self._replay, self._c)))
       self._build_model()
 
   def __call__(self, obs, reset, state=None, training=True):
     step = self._step.numpy().item()
     tf.summary.experimental.set_step(step)
-    if state is not None and reset.any():
-      mask = tf.cast(1 - reset, self._float)[:, None]
-      state = tf.nest.map_structure(lambda x: x * mask, state)
-    if self._should_train(step):
-      log = self._should_log(step)
-      n = self._c.pretrain if self._should_pretrain() else self._c.train_steps
-      print(f'Training for {n} steps.')
-      with self._strategy.scope():
-        for train_step in range(n):
-          log_images = self._c.log_images and log and train_step == 0
-          self.train(next(self._dataset), log_images)
-      if log:
-        self._write_summaries()
-    action, state = self.policy(obs, state, training)
+    if self._c.async_learner:
+      self._sync_policy(obs, state, training)
+    else:
+      n = self._train_amount(step)
+      if n:
+        log = self._should_log(step)
+        print(f'Training for {n} steps.')
+        start = time.time()
+        with self._strategy.scope():
+          for train_step in range(n):
+            log_images = self._c.log_images and log and train_step == 0
+            self.train(next(self._dataset), log_images)
+        if self._c.train_schedule != 'every':
+          self._schedule.record(n, time.time() - start)
+        if log:
+          self._write_summaries()
+    action, state = self.policy(obs, state, training, reset)
     if training:
       self._step.assign_add(len(reset) * self._c.action_repeat)
+      if self._c.async_learner:
+        self._wait_for_learner()
     sys.stdout.flush()
     return action, state
 
-  @tf.function
-  def policy(self, obs, state, training):
+  @property
+  def policy_traces(self):
+    return self._policy_traces
+
+  def policy(self, obs, state, training, reset=None):
+    # The policy functions have a fixed input signature, so they are traced
+    # once, when the first observation shows the shapes. The keys are the ones
+    # the model consumes, so state-only runs ignore the images that test envs
+    # render. Envs that are reset in the batch start from the initial state
+    # inside the graph.
+    keys = ('state', 'reward') if self._c.state_only else (
+        'image', 'state', 'reward')
+    obs = {k: obs[k] for k in keys if k in obs}
+    if self._policy_signature is None:
+      self._trace_policy(obs)
+    specs = self._policy_signature[0]
+    if obs.keys() != specs.keys():
+      raise ValueError(
+          f'Policy expects the keys {sorted(specs)} but got {sorted(obs)}.')
+    obs = {k: np.asarray(v, specs[k].dtype.as_numpy_dtype)
+           for k, v in obs.items()}
     if state is None:
-      latent = self._dynamics.initial(len(obs['image']))
-      action = tf.zeros((len(obs['image']), self._actdim), self._float)
-    else:
-      latent, action = state
-    embed = self._encode(preprocess(obs, self._c))
-    if 'state' in obs:
-      state = tf.dtypes.cast(obs['state'], embed.dtype)
-      embed = tf.concat([state, embed], axis=-1)
-    latent, _ = self._dynamics.obs_step(latent, action, embed)
-    feat = self._dynamics.get_feat(latent)
-    if training:
-      action = self._actor(feat).sample()
-    else:
-      action = self._actor(feat).mode()
+      state = self._initial_state(len(obs['reward']))
+    if reset is None:
+      reset = np.zeros(len(obs['reward']), np.bool)
+    args = obs, state, np.asarray(reset, np.bool), tf.constant(training)
+    if self._compiled_policy:
+      try:
+        return self._compiled_policy(*args)
+      except tf.errors.OpError as e:
+        # Compilation fails before running anything, so nothing is repeated.
+        print('Falling back to the policy without XLA:', e.message)
+        self._compiled_policy = None
+    return self._traced_policy(*args)
+
+  def _trace_policy(self, obs):
+    encode, dynamics, actor = self._policy_modules
+    self._initial_state = tf.function(
+        lambda batch: (
+            dynamics.initial(batch),
+            tf.zeros((batch, self._actdim), self._float)),
+        input_signature=[tf.TensorSpec((), tf.int32)])
+    spec = lambda x: tf.TensorSpec((None,) + tuple(x.shape[1:]), x.dtype)
+    signature = [
+        {k: spec(np.asarray(v)) for k, v in obs.items()},
+        tf.nest.map_structure(spec, self._initial_state(1)),
+        tf.TensorSpec((None,), tf.bool),
+        tf.TensorSpec((), tf.bool)]
+    self._traced_policy = tf.function(self._policy, input_signature=signature)
+    self._traced_policy.get_concrete_function()
+    if self._c.jit:
+      self._compiled_policy = tf.function(
+          self._policy, input_signature=signature, experimental_compile=True)
+      self._compiled_policy.get_concrete_function()
+    self._policy_signature = signature
+
+  def _policy(self, obs, state, reset, training):
+    self._policy_traces += 1  # Only runs while tracing.
+    encode, dynamics, actor = self._policy_modules
+    mask = tf.cast(tf.logical_not(reset), self._float)[:, None]
+    latent, action = tf.nest.map_structure(lambda x: x * mask, state)
+    embed = self._embed(preprocess(obs, self._c), encode)
+    latent, _ = dynamics.obs_step(latent, action, embed)
+    feat = dynamics.get_feat(latent)
+    dist = actor(feat)
+    action = tf.cond(training, dist.sample, dist.mode)
     action = self._exploration(action, training)
     state = (latent, action)
     return action, state
@@ -249,25 +355,30 @@ class Dreamer(tools.Module):
     super().load(filename)
     self._should_pretrain()
 
+  def save(self, filename):
+    with self._lock:
+      super().save(filename)
+
   @tf.function()
   def train(self, data, log_images=False):
     self._strategy.experimental_run_v2(self._train, args=(data, log_images))
 
   def _train(self, data, log_images):
+    if self._c.device_preprocess:
+      data = preprocess(data, self._c)
     with tf.GradientTape() as model_tape:
       if 'success' in data:
         success_rate = tf.reduce_sum(data['success']) / data['success'].shape[1]
       else:
         success_rate = tf.convert_to_tensor(-1)
-      embed = self._encode(data)
-      if 'state' in data:
-        embed = tf.concat([data['state'], embed], axis=-1)
+      embed = self._embed(data, self._encode)
       post, prior = self._dynamics.observe(embed, data['action'])
       feat = self._dynamics.get_feat(post)
-      image_pred = self._decode(feat)
       reward_pred = self._reward(feat)
       likes = tools.AttrDict()
-      likes.image = tf.reduce_mean(image_pred.log_prob(data['image']))
+      if not self._c.state_only:
+        image_pred = self._decode(feat)
+        likes.image = tf.reduce_mean(image_pred.log_prob(data['image']))
       reward_obj = reward_pred.log_prob(data['reward'])
 
       # Mask out the elements which came from the real world env
@@ -318,7 +429,7 @@ class Dreamer(tools.Module):
             data, feat, prior_dist, post_dist, likes, div,
             model_loss, value_loss, actor_loss, model_norm, value_norm,
             actor_norm, success_rate)
-      if tf.equal(log_images, True):
+      if not self._c.state_only and tf.equal(log_images, True):
         self._image_summaries(data, embed, image_pred)
 
   def _build_model(self):
@@ -339,7 +450,9 @@ class Dreamer(tools.Module):
     self._actor = models.ActionDecoder(
         self._actdim, 4, self._c.num_units, self._c.action_dist,
         init_std=self._c.action_init_std, act=act)
-    model_modules = [self._encode, self._dynamics, self._decode, self._reward]
+    model_modules = [self._dynamics, self._reward]
+    if not self._c.state_only:
+      model_modules += [self._encode, self._decode]
     if self._c.pcont:
       model_modules.append(self._pcont)
     Optimizer = functools.partial(
@@ -348,34 +461,120 @@ class Dreamer(tools.Module):
     self._model_opt = Optimizer('model', model_modules, self._c.model_lr)
     self._value_opt = Optimizer('value', [self._value], self._c.value_lr)
     self._actor_opt = Optimizer('actor', [self._actor], self._c.actor_lr)
+    self._policy_modules = (self._encode, self._dynamics, self._actor)
+    self._policy_signature = None
+    self._traced_policy = None
+    self._compiled_policy = None
+    self._policy_traces = 0
+    if self._c.async_learner:
+      # The agent acts with a copy of the modules that the policy uses, so that
+      # train steps do not change the weights in the middle of a policy step.
+      self._policy_modules = (
+          models.ConvEncoder(self._c.cnn_depth, cnn_act),
+          models.RSSM(
+              self._c.stoch_size, self._c.deter_size, self._c.deter_size),
+          models.ActionDecoder(
+              self._actdim, 4, self._c.num_units, self._c.action_dist,
+              init_std=self._c.action_init_std, act=act))
     # Do a train step to initialize all variables, including optimizer
     # statistics. Ideally, we would use batch size zero, but that doesn't work
     # in multi-GPU mode.
     self.train(next(self._dataset))
 
+  def _embed(self, obs, encode):
+    # State-only runs never see images during training and skip the encoder.
+    if self._c.state_only:
+      return tf.cast(obs['state'], self._float)
+    embed = encode(obs)
+    if 'state' in obs:
+      state = tf.cast(obs['state'], embed.dtype)
+      embed = tf.concat([state, embed], axis=-1)
+    return embed
+
+  def _train_amount(self, step):
+    if self._c.train_schedule == 'every':
+      if not self._should_train(step):
+        return 0
+      return self._c.pretrain if self._should_pretrain() else self._c.train_steps
+    n = self._schedule(step)
+    return self._c.pretrain if self._should_pretrain() else n
+
+  def _sync_policy(self, obs, state, training):
+    if self._learner is None:
+      # Trace the policy once to create the variables of the copy.
+      self.policy(obs, state, training)
+      self._synced = -np.inf
+      pretrain = self._c.pretrain if self._should_pretrain() else 0
+      start = int(self._step.numpy())
+      ratio = self._c.train_ratio or self._c.train_steps / self._c.train_every
+      self._target = lambda step: pretrain + ratio * (step - start)
+      self._progress = threading.Condition()
+      self._learner = threading.Thread(target=self._learn, daemon=True)
+      self._learner.start()
+    if self._updates - self._synced < self._c.policy_sync_every:
+      return
+    sources = [self._encode, self._dynamics, self._actor]
+    with self._lock:
+      for source, target in zip(sources, self._policy_modules):
+        assert len(source.variables) == len(target.variables)
+        for x, y in zip(source.variables, target.variables):
+          y.assign(x)
+      self._synced = self._updates
+
+  def _wait_for_learner(self):
+    with self._progress:
+      self._progress.notify_all()
+      while self._target(self._step.numpy()) - self._updates > (
+          self._c.max_staleness):
+        if not self._learner.is_alive():
+          raise RuntimeError('The learner thread stopped.')
+        self._progress.wait(1)
+
+  def _learn(self):
+    # Train steps keep up with the env steps the agent takes, at the ratio.
+    with self._writer.as_default(), self._strategy.scope():
+      while True:
+        with self._progress:
+          while self._target(self._step.numpy()) <= self._updates:
+            self._progress.wait()
+        step = int(self._step.numpy())
+        tf.summary.experimental.set_step(step)
+        log = self._should_log(step)
+        data = next(self._dataset)
+        with self._lock:
+          self.train(data, self._c.log_images and log)
+        with self._progress:
+          self._updates += 1
+          self._progress.notify_all()
+        if log:
+          self._write_summaries()
+
   def _exploration(self, action, training):
-    if training:
-      amount = self._c.expl_amount
-      if self._c.expl_decay:
-        amount *= 0.5 ** (tf.cast(self._step, tf.float32) / self._c.expl_decay)
-      if self._c.expl_min:
-        amount = tf.maximum(self._c.expl_min, amount)
-      self._metrics['expl_amount'].update_state(amount)
-    elif self._c.eval_noise:
-      amount = self._c.eval_noise
-    else:
-      return action
+    # Training is a boolean tensor, so both cases are part of the graph.
+    amount = self._c.expl_amount
+    if self._c.expl_decay:
+      amount *= 0.5 ** (tf.cast(self._step, tf.float32) / self._c.expl_decay)
+    if self._c.expl_min:
+      amount = tf.maximum(self._c.expl_min, amount)
+    self._metrics['expl_amount'].update_state(
+        amount, tf.cast(training, tf.float32))
+    amount = tf.where(training, amount, self._c.eval_noise)
     if self._c.expl == 'additive_gaussian':
-      return tf.clip_by_value(tfd.Normal(action, amount).sample(), -1, 1)
-    if self._c.expl == 'completely_random':
-      return tf.random.uniform(action.shape, -1, 1)
-    if self._c.expl == 'epsilon_greedy':
+      noisy = tfd.Normal(action, tf.cast(amount, action.dtype)).sample()
+      noisy = tf.clip_by_value(noisy, -1, 1)
+    elif self._c.expl == 'completely_random':
+      noisy = tf.random.uniform(tf.shape(action), -1, 1, action.dtype)
+    elif self._c.expl == 'epsilon_greedy':
       indices = tfd.Categorical(0 * action).sample()
-      return tf.where(
-          tf.random.uniform(action.shape[:1], 0, 1) < amount,
+      noisy = tf.where(
+          tf.random.uniform(tf.shape(action)[:1], 0, 1) < amount,
           tf.one_hot(indices, action.shape[-1], dtype=self._float),
           action)
-    raise NotImplementedError(self._c.expl)
+    else:
+      raise NotImplementedError(self._c.expl)
+    if self._c.eval_noise:
+      return noisy
+    return tf.where(training, noisy, action)
 
   def _imagine_ahead(self, post):
     if self._c.pcont:  # Last step could be terminal.
@@ -424,6 +623,10 @@ class Dreamer(tools.Module):
   def _write_summaries(self):
     step = int(self._step.numpy())
     metrics = [(k, float(v.result())) for k, v in self._metrics.items()]
+    metrics += [(k, float(v)) for k, v in self._replay.stats().items()]
+    metrics.append(('policy_traces', self._policy_traces))
+    if self._c.train_schedule != 'every' and not self._c.async_learner:
+      metrics += [(k, float(v)) for k, v in self._schedule.stats().items()]
     if self._last_log is not None:
       duration = time.time() - self._last_time
       self._last_time += duration
@@ -441,8 +644,13 @@ class Dreamer(tools.Module):
 def preprocess(obs, config):
   dtype = prec.global_policy().compute_dtype
   obs = obs.copy()
-  with tf.device('cpu:0'):
-    obs['image'] = tf.cast(obs['image'], dtype) / 255.0 - 0.5
+  if config.device_preprocess:
+    device = contextlib.nullcontext()
+  else:
+    device = tf.device('cpu:0')
+  with device:
+    if 'image' in obs:
+      obs['image'] = tf.cast(obs['image'], dtype) / 255.0 - 0.5
     clip_rewards = dict(none=lambda x: x, tanh=tf.tanh)[config.clip_rewards]
     obs['reward'] = clip_rewards(obs['reward'])
   return obs
@@ -452,21 +660,34 @@ def count_steps(datadir, config):
   return tools.count_episodes(datadir)[1] * config.action_repeat
 
 
-def load_dataset(directory, config):
-  episode = next(tools.load_episodes(directory, 1))
-  types = {k: v.dtype for k, v in episode.items()}
-  shapes = {k: (None,) + v.shape[1:] for k, v in episode.items()}
-  generator = lambda: tools.load_episodes(
-      directory, config.train_steps, config.batch_length,
-      config.dataset_balance, real_world_prob=config.real_world_prob)
-  dataset = tf.data.Dataset.from_generator(generator, types, shapes)
-  dataset = dataset.batch(config.batch_size, drop_remainder=True)
-  dataset = dataset.map(functools.partial(preprocess, config=config))
-  dataset = dataset.prefetch(10)
+def load_dataset(replay, config):
+  prefetch = 10
+  workers = config.loader_workers
+  # Every worker samples from the shared replay with its own random stream and
+  # the shards are interleaved round robin to keep the batch order fixed.
+  seeds = np.random.SeedSequence(config.seed).spawn(workers)
+  samplers = [tools.BatchSampler(
+      replay, config.batch_size, config.batch_length, config.dataset_balance,
+      seed.generate_state(4), config.real_world_prob)
+      for seed in seeds]
+  batch = samplers[0]()
+  types = {k: v.dtype for k, v in batch.items()}
+  shapes = {k: v.shape for k, v in batch.items()}
+  generator = lambda index: iter(samplers[index])
+  dataset = tf.data.Dataset.range(workers).interleave(
+      lambda index: tf.data.Dataset.from_generator(
+          generator, types, shapes, args=(index,)),
+      cycle_length=workers, block_length=1, num_parallel_calls=workers)
+  if not config.device_preprocess:
+    dataset = dataset.map(
+        functools.partial(preprocess, config=config),
+        num_parallel_calls=workers)
+  dataset = dataset.prefetch(prefetch)
   return dataset
 
 
-def summarize_episode(episode, config, datadir, writer, prefix):
+def summarize_episode(
+    episode, config, datadir, writer, prefix, episode_writer=None):
   episodes, steps = tools.count_episodes(datadir)
   length = (len(episode['reward']) - 1) * config.action_repeat
   ret = episode['reward'].sum()
@@ -474,6 +695,8 @@ def summarize_episode(episode, config, datadir, writer, prefix):
       (f'{prefix}/return', float(episode['reward'].sum())),
       (f'{prefix}/length', len(episode['reward']) - 1),
       (f'episodes', episodes)]
+  if episode_writer:
+    metrics += [(f'{prefix}/{k}', v) for k, v in episode_writer.stats().items()]
   if 'success' in episode:
     success = True in episode['success']
     success_str = "succeeded" if success == 1 else "did not succeed"
@@ -494,14 +717,16 @@ def summarize_episode(episode, config, datadir, writer, prefix):
 
 def make_env(config, writer, prefix, datadir, store, index=None, real_world=False):
   suite, task = config.task.split('_', 1)
+  images = not config.state_only or prefix == 'test'
   if suite == 'dmc':
+    assert config.use_state or not config.state_only
     if config.dr is None or real_world: #first index is always real world
-      env = wrappers.DeepMindControl(task, use_state=config.use_state, real_world=real_world)
+      env = wrappers.DeepMindControl(task, use_state=config.use_state, real_world=real_world,
+                                     images=images, reset_pool=config.reset_pool)
     else:
       env = wrappers.DeepMindControl(task, dr=config.dr, use_state=config.use_state,
-                                     real_world=real_world)
-    env = wrappers.ActionRepeat(env, config.action_repeat)
-    env = wrappers.NormalizeActions(env)
+                                     real_world=real_world, images=images,
+                                     reset_pool=config.reset_pool)
   elif suite == 'atari':
     env = wrappers.Atari(
         task, config.action_repeat, (64, 64), grayscale=False,
@@ -509,20 +734,32 @@ def make_env(config, writer, prefix, datadir, store, index=None, real_world=Fals
     env = wrappers.OneHotAction(env)
   elif suite == 'gym':
     if index == 0 or index is None: #first index is always real world
-      env = wrappers.GymControl(task)
+      env = wrappers.GymControl(
+          task, keep_pixels=config.keep_pixels, images=images,
+          reset_pool=config.reset_pool)
     else:
-      env = wrappers.GymControl(task, dr=config.dr)
-    env = wrappers.ActionRepeat(env, config.action_repeat)
-    env = wrappers.NormalizeActions(env)
+      env = wrappers.GymControl(
+          task, dr=config.dr, keep_pixels=config.keep_pixels, images=images,
+          reset_pool=config.reset_pool)
 
   else:
     raise NotImplementedError(suite)
-  env = wrappers.TimeLimit(env, config.time_limit / config.action_repeat)
   callbacks = []
+  episode_writer = None
   if store:
-    callbacks.append(lambda ep: tools.save_episodes(datadir, [ep]))
-  callbacks.append(
-      lambda ep: summarize_episode(ep, config, datadir, writer, prefix))
+    episode_writer = tools.EpisodeWriter(
+        datadir, config.episode_format, config.episode_codec)
+    callbacks.append(episode_writer)
+  callbacks.append(lambda ep: summarize_episode(
+      ep, config, datadir, writer, prefix, episode_writer))
+  duration = config.time_limit / config.action_repeat
+  if suite in ('dmc', 'gym') and config.fused_wrappers:
+    return wrappers.FusedControl(
+        env, config.action_repeat, duration, callbacks, config.precision)
+  if suite in ('dmc', 'gym'):
+    env = wrappers.ActionRepeat(env, config.action_repeat)
+    env = wrappers.NormalizeActions(env)
+  env = wrappers.TimeLimit(env, duration)
   env = wrappers.Collect(env, callbacks, config.precision)
   env = wrappers.RewardObs(env)
   return env
@@ -535,27 +772,37 @@ def main(config):
   assert config.precision in (16, 32), config.precision
   if config.precision == 16:
     prec.set_policy(prec.Policy('mixed_float16'))
+  tools.SCAN_MODE = config.scan_mode
+  if config.jit:
+    tools.enable_jit()
   config.steps = int(config.steps)
   config.logdir.mkdir(parents=True, exist_ok=True)
   print('Logdir', config.logdir)
 
   # Create environments.
   datadir = config.logdir / 'episodes'
+  # The previous run may have been killed between writing an episode and
+  # adding it to the manifest.
+  tools.EpisodeIndex(datadir).rebuild()
   writer = tf.summary.create_file_writer(
       str(config.logdir), max_queue=1000, flush_millis=20000)
   writer.set_as_default()
-  train_sim_envs = [wrappers.Async(lambda: make_env(
-      config, writer, 'sim_train', datadir, store=True, real_world=False), config.parallel)
-      for i in range(config.envs)]
+  wrappers.preload(*config.task.split('_', 1))
+  assert config.envs % config.envs_per_worker == 0, config.envs
+  workers = config.envs // config.envs_per_worker
+  make_worker = lambda prefix, store, real_world: wrappers.Async(
+      lambda: wrappers.Batch([make_env(
+          config, writer, prefix, datadir, store=store, real_world=real_world)
+          for _ in range(config.envs_per_worker)]),
+      config.parallel, config.async_transport)
+  train_sim_envs = [
+      make_worker('sim_train', True, False) for _ in range(workers)]
   if config.real_world_prob > 0:
-    train_real_envs = [wrappers.Async(lambda: make_env(
-      config, writer, 'real_train', datadir, store=True, real_world=True), config.parallel)
-                  for _ in range(config.envs)]
+    train_real_envs = [
+        make_worker('real_train', True, True) for _ in range(workers)]
   else:
     train_real_envs = None
-  test_envs = [wrappers.Async(lambda: make_env(
-      config, writer, 'test', datadir, store=False, real_world=True), config.parallel)
-      for _ in range(config.envs)]
+  test_envs = [make_worker('test', False, True) for _ in range(workers)]
   actspace = train_sim_envs[0].action_space
 
   # Prefill dataset with random episodes.
@@ -563,7 +810,9 @@ def main(config):
   prefill = max(0, config.prefill - step)
   print(f'Prefill dataset with {prefill} steps.')
   random_agent = lambda o, d, _: ([actspace.sample() for _ in d], None)
-  tools.simulate(random_agent, train_sim_envs, prefill / config.action_repeat)
+  tools.simulate(
+      random_agent, train_sim_envs, prefill / config.action_repeat,
+      first_ready=config.first_ready)
   writer.flush()
   train_real_step_target = config.sample_real_every * config.time_limit
 
@@ -586,10 +835,14 @@ def main(config):
     writer.flush()
     steps = config.eval_every // config.action_repeat
     print('Start collection from simulator.')
-    state = tools.simulate(agent, train_sim_envs, steps, state=state)
+    state = tools.simulate(
+        agent, train_sim_envs, steps, state=state,
+        first_ready=config.first_ready)
     if step >= train_real_step_target and train_real_envs is not None:
       print("Start collection from the real world")
-      state = tools.simulate(agent, train_real_envs, episodes=1, state=state)
+      state = tools.simulate(
+          agent, train_real_envs, episodes=1, state=state,
+          first_ready=config.first_ready)
       train_real_step_target += config.sample_real_every * config.time_limit
     old_step = step
     step = count_steps(datadir, config)
@@ -46,6 +46,10 @@ class FetchEnv(robot_env.RobotEnv):
         self.use_vision = use_vision
         self.deterministic = deterministic
         self.real_world = real_world
+        self.render_pixels = True
+        self._state_id = 0
+        self._image_key = None
+        self._image = None
 
         super(FetchEnv, self).__init__(
             model_path=model_path, n_substeps=n_substeps, n_actions=4,
@@ -86,6 +90,7 @@ class FetchEnv(robot_env.RobotEnv):
     # ----------------------------
 
     def _step_callback(self):
+        self._state_id += 1
         if self.block_gripper:
             self.sim.data.set_joint_qpos('robot0:l_gripper_finger_joint', 0.)
             self.sim.data.set_joint_qpos('robot0:r_gripper_finger_joint', 0.)
@@ -145,11 +150,8 @@ class FetchEnv(robot_env.RobotEnv):
         state = np.concatenate([obs.copy(), self.goal.copy()])
         real_world = 1.0 if self.real_world else 0.0
         if self.use_vision:
-            img_size = 64
-            img = self.sim.render(width=img_size, height=img_size, camera_name="external_camera_0")[::-1]
             state = {
                 "state": obs_noobj,
-                "pixels": img,
                 'observation': state,
                 'grip_pos': grip_pos.copy(),
                 'obj_pos': object_pos.copy(),
@@ -158,6 +160,8 @@ class FetchEnv(robot_env.RobotEnv):
                 'success': success,
                 'real_world': np.array(real_world),
             }
+            if self.render_pixels:
+                state['pixels'] = self.render_image()
         else:
             state = {
                 "state" : state,
@@ -187,6 +191,7 @@ class FetchEnv(robot_env.RobotEnv):
         self.sim.forward()
 
     def _reset_sim(self):
+        self._state_id += 1
         self.sim.set_state(self.initial_state)
 
         # Randomize start position of object.
@@ -242,5 +247,17 @@ class FetchEnv(robot_env.RobotEnv):
         if self.has_object:
             self.height_offset = self.sim.data.get_site_xpos('object0')[2]
 
+    def render_image(self, width=64, height=64, camera_name="external_camera_0"):
+        """Renders a camera image of the current simulation state.
+
+        The last image is cached until the simulation is stepped or reset, so that
+        the observation and the wrappers share a single render per step.
+        """
+        key = (self._state_id, width, height, camera_name)
+        if key != self._image_key:
+            self._image = self.sim.render(width=width, height=height, camera_name=camera_name)[::-1]
+            self._image_key = key
+        return self._image
+
     def render(self, mode='human', width=500, height=500):
         return super(FetchEnv, self).render(mode, width, height)
\ No newline at end of file
@@ -14,6 +14,22 @@ except ImportError as e:
 
 DEFAULT_SIZE = 500
 
+# Compiled models by path. Parsing and compiling the XML is the slow part of
+# creating an env, so it happens once per process and later envs load the
+# compiled binary. Env workers forked after a preload inherit the cache.
+_MODELS = {}
+
+def load_model(model_path):
+    if model_path.startswith('/'):
+        fullpath = model_path
+    else:
+        fullpath = os.path.join(os.path.dirname(__file__), 'assets', model_path)
+    if not os.path.exists(fullpath):
+        raise IOError('File {} does not exist'.format(fullpath))
+    if fullpath not in _MODELS:
+        _MODELS[fullpath] = mujoco_py.load_model_from_path(fullpath).get_mjb()
+    return mujoco_py.load_model_from_mjb(_MODELS[fullpath])
+
 def convert_observation_to_space(observation):
     if isinstance(observation, dict):
         space = spaces.Dict(OrderedDict([
@@ -31,14 +47,7 @@ def convert_observation_to_space(observation):
 
 class RobotEnv(gym.GoalEnv):
     def __init__(self, model_path, initial_qpos, n_actions, n_substeps):
-        if model_path.startswith('/'):
-            fullpath = model_path
-        else:
-            fullpath = os.path.join(os.path.dirname(__file__), 'assets', model_path)
-        if not os.path.exists(fullpath):
-            raise IOError('File {} does not exist'.format(fullpath))
-
-        model = mujoco_py.load_model_from_path(fullpath)
+        model = load_model(model_path)
         self.model = model
         self.sim = mujoco_py.MjSim(model, nsubsteps=n_substeps)
         self.viewer = None
@@ -1,9 +1,15 @@
+import collections
 import datetime
 import io
 import pathlib
 import pickle
+import queue
 import re
+import shutil
+import threading
+import time
 import uuid
+import zipfile
 
 import gym
 import numpy as np
@@ -97,102 +103,573 @@ def encode_gif(frames, fps):
   return out
 
 
-def simulate(agent, envs, steps=0, episodes=0, state=None):
-  # Initialize or unpack simulation state.
+def simulate(agent, envs, steps=0, episodes=0, state=None, first_ready=False):
+  # Every entry of envs hosts a batch of environments, see wrappers.Batch, and
+  # is stepped with a single call per step.
+  if first_ready:
+    return _simulate_first_ready(agent, envs, steps, episodes, state)
+  sizes = [env.num_envs for env in envs]
+  bounds = list(zip(np.cumsum([0] + sizes[:-1]), np.cumsum(sizes)))
+  # Initialize or unpack simulation state. The done mask tells the agent which
+  # envs start a new episode and the needs_reset mask which envs still have to
+  # be reset, so that resets already received are not repeated on resume.
   if state is None:
     step, episode = 0, 0
-    done = np.ones(len(envs), np.bool)
-    length = np.zeros(len(envs), np.int32)
-    obs = [None] * len(envs)
+    done = np.ones(sum(sizes), np.bool)
+    length = np.zeros(sum(sizes), np.int32)
+    obs = [None] * sum(sizes)
     agent_state = None
+    needs_reset = np.ones(sum(sizes), np.bool)
   else:
-    step, episode, done, length, obs, agent_state = state
+    step, episode, done, length, obs, agent_state, needs_reset = state
+    needs_reset = needs_reset.copy()
   while (steps and step < steps) or (episodes and episode < episodes):
     # Reset envs if necessary.
-    if done.any():
-      indices = [index for index, d in enumerate(done) if d]
-      promises = [envs[i].reset(blocking=False) for i in indices]
-      for index, promise in zip(indices, promises):
-        obs[index] = promise()
+    if needs_reset.any():
+      promises = []
+      for env, (start, stop) in zip(envs, bounds):
+        indices = np.flatnonzero(needs_reset[start: stop])
+        if len(indices):
+          promises.append((start + indices, env.reset(indices, blocking=False)))
+      for indices, promise in promises:
+        reset = promise()
+        for i, index in enumerate(indices):
+          obs[index] = {k: v[i] for k, v in reset.items()}
+      needs_reset[:] = False
     # Step agents.
     obs = {k: np.stack([o[k] for o in obs]) for k in obs[0]}
     action, agent_state = agent(obs, done, agent_state)
     action = np.array(action)
-    assert len(action) == len(envs)
+    assert len(action) == sum(sizes)
     # Step envs.
-    promises = [e.step(a, blocking=False) for e, a in zip(envs, action)]
-    obs, _, done = zip(*[p()[:3] for p in promises])
-    obs = list(obs)
-    done = np.stack(done)
+    promises = [
+        env.step(action[start: stop], blocking=False)
+        for env, (start, stop) in zip(envs, bounds)]
+    obs, done = [], []
+    for promise in promises:
+      batch_obs, _, batch_done = promise()[:3]
+      obs += [{k: v[i] for k, v in batch_obs.items()}
+              for i in range(len(batch_done))]
+      done.append(batch_done)
+    done = np.concatenate(done)
+    needs_reset = done.copy()
     episode += int(done.sum())
     length += 1
     step += (done * length).sum()
     length *= (1 - done)
   # Return new state to allow resuming the simulation.
-  return (step - steps, episode - episodes, done, length, obs, agent_state)
+  return (
+      step - steps, episode - episodes, done, length, obs, agent_state,
+      needs_reset)
+
+
+def _simulate_first_ready(agent, envs, steps, episodes, state):
+  # Instead of stepping all workers in lockstep, act on whichever workers have
+  # returned their observations so far, so that a slow worker does not hold
+  # back the others. The agent state is kept for all envs and the agent sees
+  # the slices of the ready envs. All workers are idle again on return, so the
+  # simulation state can be resumed in either mode.
+  sizes = [env.num_envs for env in envs]
+  bounds = list(zip(np.cumsum([0] + sizes[:-1]), np.cumsum(sizes)))
+  if state is None:
+    step, episode = 0, 0
+    done = np.ones(sum(sizes), np.bool)
+    length = np.zeros(sum(sizes), np.int32)
+    obs = [None] * sum(sizes)
+    agent_state = None
+    needs_reset = np.ones(sum(sizes), np.bool)
+  else:
+    step, episode, done, length, obs, agent_state, needs_reset = state
+    done, obs, needs_reset = done.copy(), list(obs), needs_reset.copy()
+  stepped = list(range(len(envs)))  # Idle, their envs may need a reset.
+  acting = []  # Idle, all their envs hold a current observation.
+  pending = {}
+  def receive(worker):
+    nonlocal step, episode
+    indices, promise = pending.pop(worker)
+    if indices is not None:
+      reset = promise()
+      for i, index in enumerate(indices):
+        obs[index] = {k: v[i] for k, v in reset.items()}
+      needs_reset[indices] = False
+      acting.append(worker)
+      return
+    start, stop = bounds[worker]
+    batch_obs, _, batch_done = promise()[:3]
+    obs[start: stop] = [
+        {k: v[i] for k, v in batch_obs.items()} for i in range(stop - start)]
+    done[start: stop] = batch_done
+    needs_reset[start: stop] = batch_done
+    episode += int(batch_done.sum())
+    length[start: stop] += 1
+    step += (batch_done * length[start: stop]).sum()
+    length[start: stop] *= (1 - batch_done)
+    stepped.append(worker)
+  while (steps and step < steps) or (episodes and episode < episodes):
+    # Reset envs if necessary.
+    for worker in stepped:
+      start, stop = bounds[worker]
+      indices = np.flatnonzero(needs_reset[start: stop])
+      if len(indices):
+        promise = envs[worker].reset(indices, blocking=False)
+        pending[worker] = start + indices, promise
+      else:
+        acting.append(worker)
+    stepped.clear()
+    # Step agents of the ready envs.
+    if acting:
+      index = np.concatenate([np.arange(*bounds[w]) for w in acting])
+      batch = {k: np.stack([obs[i][k] for i in index]) for k in obs[index[0]]}
+      part = None if agent_state is None else tf.nest.map_structure(
+          lambda x: x[index], agent_state)
+      action, part = agent(batch, done[index], part)
+      action = np.array(action)
+      assert len(action) == len(index)
+      agent_state = _scatter_state(agent_state, part, index, sum(sizes))
+      offset = 0
+      for worker in acting:
+        size = sizes[worker]
+        promise = envs[worker].step(
+            action[offset: offset + size], blocking=False)
+        pending[worker] = None, promise
+        offset += size
+      acting.clear()
+    # Wait for the first workers to finish.
+    for worker in _wait_workers(envs, pending):
+      receive(worker)
+  # Resets received here are recorded in needs_reset, while done still marks
+  # those envs as starting an episode for the agent.
+  for worker in list(pending):
+    receive(worker)
+  return (
+      step - steps, episode - episodes, done, length, obs, agent_state,
+      needs_reset)
+
+
+def _wait_workers(envs, pending):
+  conns = {envs[worker].connection: worker for worker in pending}
+  if None in conns:
+    # Thread and in-process workers have nothing to wait on.
+    return list(pending)
+  from multiprocessing import connection
+  return [conns[conn] for conn in connection.wait(list(conns.keys()))]
+
+
+def _scatter_state(full, part, index, size):
+  if part is None:
+    return None
+  part = tf.nest.map_structure(np.asarray, part)
+  if full is None:
+    full = tf.nest.map_structure(
+        lambda x: np.zeros((size,) + x.shape[1:], x.dtype), part)
+  else:
+    full = tf.nest.map_structure(
+        lambda x: x if isinstance(x, np.ndarray) else np.array(x), full)
+  for target, source in zip(tf.nest.flatten(full), tf.nest.flatten(part)):
+    target[index] = source
+  return full
+
+
+class EpisodeIndex:
+
+  # Append-only manifest of the episode files in a directory. Writers append a
+  # line once an episode file is complete and readers tail the manifest from
+  # the last offset they consumed, so discovering new episodes and counting
+  # steps does not touch the rest of the directory.
+
+  FILENAME = 'manifest.txt'
+
+  def __init__(self, directory):
+    self._directory = pathlib.Path(directory).expanduser()
+    self._manifest = self._directory / self.FILENAME
+    self._lock = threading.Lock()
+    self._offset = 0
+    self.filenames = []
+    self.steps = 0
+
+  def update(self):
+    with self._lock:
+      if not self._manifest.exists():
+        if not _episode_files(self._directory):
+          return []
+        self._rebuild()
+      with self._manifest.open('rb') as f:
+        f.seek(self._offset)
+        content = f.read()
+      # Ignore a trailing line that is still being written.
+      content = content[:content.rfind(b'\n') + 1]
+      self._offset += len(content)
+      filenames = [self._directory / n for n in content.decode('utf-8').split()]
+      self.filenames += filenames
+      self.steps += sum(_episode_length(n) - 1 for n in filenames)
+      return filenames
+
+  def rebuild(self):
+    # Recreate the manifest from the directory, e.g. after a crash left episode
+    # files without a manifest entry or a partially written line.
+    with self._lock:
+      self._rebuild()
+
+  def _rebuild(self):
+    self._directory.mkdir(parents=True, exist_ok=True)
+    filenames = sorted(_episode_files(self._directory))
+    temp = self._manifest.with_suffix('.tmp')
+    temp.write_text(''.join(f'{n.name}\n' for n in filenames))
+    temp.replace(self._manifest)
+    self._offset = 0
+    self.filenames = []
+    self.steps = 0
+
+
+_INDICES = {}
 
 
 def count_episodes(directory):
-  filenames = directory.glob('*.npz')
-  lengths = [int(n.stem.rsplit('-', 1)[-1]) - 1 for n in filenames]
-  episodes, steps = len(lengths), sum(lengths)
-  return episodes, steps
-
-
-def save_episodes(directory, episodes):
+  directory = pathlib.Path(directory).expanduser()
+  if directory not in _INDICES:
+    _INDICES[directory] = EpisodeIndex(directory)
+  index = _INDICES[directory]
+  index.update()
+  return len(index.filenames), index.steps
+
+
+def save_episodes(directory, episodes, format='npz', codec='zlib'):
+  # The npz format stores an archive per episode, compressed by the codec. The
+  # mmap format stores a directory with one raw npy file per key, which the
+  # loader memory maps so that sampling a segment only reads that segment from
+  # disk. Files are written under a temporary name and renamed when complete.
   directory = pathlib.Path(directory).expanduser()
   directory.mkdir(parents=True, exist_ok=True)
   timestamp = datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+  filenames = []
   for episode in episodes:
     identifier = str(uuid.uuid4().hex)
     length = len(episode['reward'])
-    filename = directory / f'{timestamp}-{identifier}-{length}.npz'
-    with io.BytesIO() as f1:
-      np.savez_compressed(f1, **episode)
-      f1.seek(0)
-      with filename.open('wb') as f2:
-        f2.write(f1.read())
+    suffix = format if format == 'mmap' else _CODEC_SUFFIXES[codec.split(':')[0]]
+    filename = directory / f'{timestamp}-{identifier}-{length}.{suffix}'
+    temp = directory / f'.{filename.name}.tmp'
+    try:
+      if format == 'npz':
+        with temp.open('wb') as f:
+          f.write(_encode_episode(episode, codec))
+      elif format == 'mmap':
+        temp.mkdir()
+        for key, value in episode.items():
+          np.save(temp / f'{key}.npy', np.asarray(value))
+      else:
+        raise NotImplementedError(format)
+      temp.rename(filename)
+    except BaseException:
+      if temp.is_dir():
+        shutil.rmtree(temp, ignore_errors=True)
+      elif temp.exists():
+        temp.unlink()
+      raise
+    # Only announce the episode once the file is complete.
+    with (directory / EpisodeIndex.FILENAME).open('a') as f:
+      f.write(f'{filename.name}\n')
+    filenames.append(filename)
+  return filenames
+
+
+def load_episode(filename):
+  filename = pathlib.Path(filename)
+  if filename.suffix == '.mmap':
+    return {
+        n.stem: np.load(n, mmap_mode='r') for n in filename.glob('*.npy')}
+  with filename.open('rb') as f:
+    content = f.read()
+  if filename.suffix == '.lz4':
+    content = _import_codec('lz4').frame.decompress(content)
+  elif filename.suffix == '.zst':
+    content = _import_codec('zstd').ZstdDecompressor().decompress(content)
+  with io.BytesIO(content) as f:
+    episode = np.load(f)
+    return {k: episode[k] for k in episode.keys()}
+
+
+_CODEC_SUFFIXES = dict(none='npz', zlib='npz', lz4='lz4', zstd='zst')
+
+
+def _encode_episode(episode, codec):
+  # Codecs are none, zlib with an optional level as in zlib:1, lz4 and zstd.
+  # The zlib codec matches np.savez_compressed at its default level.
+  name, _, level = codec.partition(':')
+  if name == 'zlib':
+    compression = dict(
+        compression=zipfile.ZIP_DEFLATED,
+        compresslevel=int(level) if level else None)
+  else:
+    compression = dict(compression=zipfile.ZIP_STORED)
+  with io.BytesIO() as f:
+    with zipfile.ZipFile(f, 'w', allowZip64=True, **compression) as archive:
+      for key, value in episode.items():
+        with archive.open(f'{key}.npy', 'w', force_zip64=True) as member:
+          np.lib.format.write_array(member, np.asanyarray(value))
+    content = f.getvalue()
+  if name == 'lz4':
+    content = _import_codec('lz4').frame.compress(content)
+  elif name == 'zstd':
+    content = _import_codec('zstd').ZstdCompressor().compress(content)
+  elif name not in ('none', 'zlib'):
+    raise NotImplementedError(codec)
+  return content
+
+
+def _check_codec(codec):
+  name, _, level = codec.partition(':')
+  if name not in _CODEC_SUFFIXES:
+    raise NotImplementedError(codec)
+  if level and (name != 'zlib' or not level.isdigit() or int(level) > 9):
+    raise ValueError(f'Invalid episode codec: {codec}')
+  if name in ('lz4', 'zstd'):
+    _import_codec(name)  # Fail early if it is not installed.
+
+
+def _import_codec(name):
+  if name == 'lz4':
+    import lz4.frame
+    return lz4
+  if name == 'zstd':
+    import zstandard
+    return zstandard
+  raise NotImplementedError(name)
+
+
+def _episode_files(directory):
+  patterns = ['*.mmap'] + [f'*.{s}' for s in set(_CODEC_SUFFIXES.values())]
+  return [n for p in patterns for n in directory.glob(p)]
+
+
+def _episode_length(filename):
+  return int(filename.stem.rsplit('-', 1)[-1])
+
+
+class EpisodeWriter:
+
+  # Saves episodes from a background thread, so the environment does not wait
+  # for compression and disk writes at the end of every episode. Adding an
+  # episode blocks only while the bounded queue is full. A failed save is
+  # raised from the next call or from close, and later episodes are dropped.
+
+  def __init__(self, directory, format='npz', codec='zlib', capacity=4):
+    if format not in ('npz', 'mmap'):
+      raise NotImplementedError(format)
+    if format == 'npz':
+      _check_codec(codec)
+    self._directory = directory
+    self._format = format
+    self._codec = codec
+    self._queue = queue.Queue(capacity)
+    self._lock = threading.Lock()
+    self._latencies = []
+    self._sizes = []
+    self._error = None
+    self._thread = threading.Thread(target=self._worker, daemon=True)
+    self._thread.start()
+
+  def __call__(self, episode):
+    self._raise()
+    self._queue.put(episode)
+
+  def stats(self):
+    with self._lock:
+      latencies, self._latencies = self._latencies, []
+      sizes, self._sizes = self._sizes, []
+    if not latencies:
+      return {}
+    return {
+        'write_latency': float(np.mean(latencies)),
+        'write_bytes': float(np.mean(sizes))}
+
+  def close(self):
+    self._queue.put(None)
+    self._thread.join()
+    self._raise()
+
+  def _raise(self):
+    if self._error is not None:
+      raise RuntimeError('Could not save episode.') from self._error
+
+  def _worker(self):
+    while True:
+      episode = self._queue.get()
+      if episode is None:
+        break
+      if self._error is not None:
+        continue
+      start = time.time()
+      try:
+        filename, = save_episodes(
+            self._directory, [episode], self._format, self._codec)
+      except Exception as e:
+        self._error = e
+        continue
+      latency = time.time() - start
+      if filename.is_dir():
+        size = sum(n.stat().st_size for n in filename.iterdir())
+      else:
+        size = filename.stat().st_size
+      with self._lock:
+        self._latencies.append(latency)
+        self._sizes.append(size)
+
+
+class Replay:
+
+  # Episodes found through the manifest, of which as many as fit into the byte
+  # budget are kept decoded in memory. Evicted episodes remain available for
+  # sampling and are read from disk again when drawn. The policy decides which
+  # episodes to evict: 'fifo' drops the oldest, 'reservoir' keeps a uniform
+  # sample of all episodes seen, and 'keep_real' drops the oldest simulator
+  # episodes but never real-world ones. Episodes are also indexed into a
+  # simulator and a real-world pool when they are first loaded. The transforms
+  # are applied whenever an episode is read from disk, after which its arrays
+  # are read-only and can be shared between sampling threads. Memory mapped
+  # episodes cost no heap but one map per key, so at most the given number of
+  # maps is kept open, dropping the oldest, and the kernel's limit on maps per
+  # process is not reached.
+
+  def __init__(
+      self, directory, budget=0, policy='fifo', seed=0, transforms=(),
+      maps=16384):
+    assert policy in ('fifo', 'reservoir', 'keep_real'), policy
+    self._index = EpisodeIndex(directory)
+    self._budget = budget
+    self._transforms = transforms
+    self._policy = policy
+    self._random = np.random.RandomState(seed)
+    self._lock = threading.Lock()
+    self._cache = collections.OrderedDict()
+    self._sizes = {}
+    self._maps = {}
+    self._max_maps = maps
+    self._open_maps = 0
+    self._pending = []
+    self._bytes = 0
+    self._hits = 0
+    self._misses = 0
+    self._evictions = 0
+    self.filenames = []
+    self.real = {}
+    self.pools = ([], [])
+
+  def update(self):
+    with self._lock:
+      filenames, self._pending = self._pending + self._index.update(), []
+      for filename in filenames:
+        if filename in self.real:
+          continue
+        episode = self._load(filename)
+        if episode is None:
+          self._pending.append(filename)
+          continue
+        self.real[filename] = (
+            bool(episode['real_world'].any())
+            if 'real_world' in episode else None)
+        self._insert(filename, episode)
+        # Samplers in other threads read the lists without the lock.
+        self.pools[bool(self.real[filename])].append(filename)
+        self.filenames.append(filename)
+
+  def get(self, filename):
+    episode = self._cache.get(filename)
+    if episode is not None:
+      self._hits += 1
+      return episode
+    self._misses += 1
+    return self._load(filename)
+
+  def stats(self):
+    lookups = self._hits + self._misses
+    stats = {
+        'replay_episodes': len(self.filenames),
+        'replay_cached': len(self._cache),
+        'replay_bytes': self._bytes,
+        'replay_maps': self._open_maps,
+        'replay_hit_rate': self._hits / lookups if lookups else 1.0,
+        'replay_evictions': self._evictions}
+    self._hits = self._misses = 0
+    return stats
+
+  def _load(self, filename):
+    try:
+      episode = load_episode(filename)
+    except Exception as e:
+      print(f'Could not load episode: {e}')
+      return None
+    for transform in self._transforms:
+      episode = transform(episode)
+    for value in episode.values():
+      value.setflags(write=False)
+    return episode
+
+  def _insert(self, filename, episode):
+    # Memory mapped arrays live in the page cache rather than the heap.
+    size = sum(
+        v.nbytes for v in episode.values() if not isinstance(v, np.memmap))
+    maps = sum(isinstance(v, np.memmap) for v in episode.values())
+    if self._budget and size > self._budget:
+      # The episode alone exceeds the budget and is read from disk when drawn.
+      self._evictions += 1
+      return
+    if self._budget and self._policy == 'reservoir':
+      if self._bytes + size > self._budget:
+        # Replace a random cached episode with probability cached / seen, where
+        # seen includes the new episode.
+        seen = len(self.filenames) + 1
+        if self._random.randint(seen) >= len(self._cache):
+          self._evictions += 1
+          return
+        while self._cache and self._bytes + size > self._budget:
+          keys = list(self._cache.keys())
+          self._evict(keys[self._random.randint(len(keys))])
+    if maps:
+      # Released maps are opened again when the episode is drawn.
+      if maps > self._max_maps:
+        self._evictions += 1
+        return
+      candidates = iter([k for k in self._cache.keys() if k in self._maps])
+      while self._open_maps + maps > self._max_maps:
+        self._evict(next(candidates))
+    self._cache[filename] = episode
+    self._sizes[filename] = size
+    self._bytes += size
+    if maps:
+      self._maps[filename] = maps
+      self._open_maps += maps
+    if self._budget and self._policy in ('fifo', 'keep_real'):
+      candidates = iter(list(self._cache.keys()))
+      while self._bytes > self._budget:
+        key = next(candidates, None)
+        if key is None:
+          break
+        if self._policy == 'keep_real' and self.real[key]:
+          continue
+        self._evict(key)
 
+  def _evict(self, filename):
+    del self._cache[filename]
+    self._bytes -= self._sizes.pop(filename)
+    self._open_maps -= self._maps.pop(filename, 0)
+    self._evictions += 1
 
-def load_episodes(directory, rescan, length=None, balance=False, seed=0, real_world_prob=-1):
-  directory = pathlib.Path(directory).expanduser()
+
+def load_episodes(replay, rescan, length=None, balance=False, seed=0, real_world_prob=-1):
   random = np.random.RandomState(seed)
-  cache = {}
   while True:
-    for filename in directory.glob('*.npz'):
-      if filename not in cache:
-        try:
-          with filename.open('rb') as f:
-            episode = np.load(f)
-            episode = {k: episode[k] for k in episode.keys()}
-        except Exception as e:
-          print(f'Could not load episode: {e}')
-          continue
-        cache[filename] = episode
-    keys = list(cache.keys())
-
-    # Weight the probability of choosing each episode by the real world by the real_world_prob argument
-    if real_world_prob >= 0 and "real_world" in cache[keys[0]]:
-      num_real = sum([True in cache[key]['real_world'] for key in keys])
-      num_sim = len(keys) - num_real
-      if num_real == 0 or num_sim == 0:
-        probs = None
-      else:
-        real_prob =  real_world_prob/num_real
-        sim_prob = (1 - real_world_prob)/num_sim
-        probs = [real_prob if True in cache[key]['real_world'] else sim_prob for key in keys]
-    else:
-      probs = None
-
-    for index in random.choice(len(keys), rescan, p=probs):
-      episode = cache[keys[index]]
-      # Make the "success" key true for all timesteps if it's true at the last timestep.
-       # This lets us accurately record the success rate.
-      if 'success' in episode:
-        new_value = episode['success'][-1]
-        success_vec = np.zeros(shape=episode['success'].shape, dtype=np.float32) + new_value
-        episode['success'] = success_vec
-
+    replay.update()
+    sim, real = replay.pools
+    if not sim and not real:
+      # Episodes written in the background may not be in the manifest yet.
+      time.sleep(0.1)
+      continue
+    prob = _real_world_fraction(len(sim), len(real), real_world_prob)
+    for _ in range(rescan):
+      pool = real if random.uniform() < prob else sim
+      episode = replay.get(pool[random.randint(len(pool))])
+      if episode is None:
+        continue
       if length:
         total = len(next(iter(episode.values())))
         available = total - length
@@ -207,6 +684,113 @@ def load_episodes(directory, rescan, length=None, balance=False, seed=0, real_wo
       yield episode
 
 
+def broadcast_success(episode):
+  # Make the "success" key true for all timesteps if it's true at the last
+  # timestep. This lets us accurately record the success rate.
+  if 'success' in episode:
+    success = episode['success']
+    episode['success'] = np.full(success.shape, success[-1], np.float32)
+  return episode
+
+
+def _real_world_fraction(num_sim, num_real, real_world_prob):
+  # Weight the probability of choosing each episode by the real world by the
+  # real_world_prob argument, or sample uniformly over all episodes.
+  if not num_sim and not num_real:
+    raise ValueError('There are no episodes to sample from.')
+  if real_world_prob >= 0 and num_sim and num_real:
+    return real_world_prob
+  return num_real / (num_sim + num_real)
+
+
+class BatchSampler:
+
+  # Draws the episodes and offsets of a whole batch at once and copies the
+  # segments into arrays of shape [batch, length, ...]. Every batch gets new
+  # arrays, because consumers such as tf.data may hold on to them without
+  # copying. Until the replay holds an episode longer than the segment length,
+  # a draw waits for the episode writers for up to `timeout` seconds.
+
+  def __init__(
+      self, replay, batch_size, length, balance=False, seed=0,
+      real_world_prob=-1, timeout=60):
+    self._replay = replay
+    self._batch_size = batch_size
+    self._length = length
+    self._balance = balance
+    self._random = np.random.RandomState(seed)
+    self._real_world_prob = real_world_prob
+    self._specs = None
+    self._timeout = timeout
+    self._seen = 0
+    self._pools = ([], [])
+
+  def __iter__(self):
+    while True:
+      yield self()
+
+  def __call__(self):
+    self._update()
+    filenames, offsets = self._draw(self._batch_size)
+    batch = None
+    for b in range(self._batch_size):
+      episode = self._replay.get(filenames[b])
+      while episode is None:
+        (filename,), (offset,) = self._draw(1)
+        filenames[b], offsets[b] = filename, offset
+        episode = self._replay.get(filename)
+      if batch is None:
+        batch = self._allocate(episode)
+      start, stop = offsets[b], offsets[b] + self._length
+      for key, value in batch.items():
+        value[b] = episode[key][start: stop]
+    return batch
+
+  def _update(self):
+    start = time.time()
+    while True:
+      self._replay.update()
+      filenames = self._replay.filenames[self._seen:]
+      self._seen += len(filenames)
+      for filename in filenames:
+        total = _episode_length(filename)
+        if total > self._length:
+          self._pools[bool(self._replay.real[filename])].append(
+              (filename, total))
+      if any(self._pools):
+        return
+      if time.time() - start > self._timeout:
+        raise RuntimeError(
+            f'No episode longer than {self._length} steps arrived in the '
+            f'replay within {self._timeout} seconds.')
+      time.sleep(0.1)
+
+  def _draw(self, amount):
+    # Choose between the simulator and real-world pool first and then
+    # uniformly within the pool, so a draw does not depend on the replay size.
+    sim, real = self._pools
+    prob = _real_world_fraction(len(sim), len(real), self._real_world_prob)
+    is_real = self._random.uniform(0, 1, amount) < prob
+    sizes = np.where(is_real, len(real), len(sim))
+    picks = (self._random.uniform(0, 1, amount) * sizes).astype(np.int64)
+    episodes = [(real if r else sim)[p] for r, p in zip(is_real, picks)]
+    filenames = [filename for filename, _ in episodes]
+    totals = np.array([total for _, total in episodes])
+    available = totals - self._length
+    if self._balance:
+      offsets = np.minimum(self._random.randint(0, totals), available)
+    else:
+      offsets = self._random.randint(0, available)
+    return filenames, offsets
+
+  def _allocate(self, episode):
+    if self._specs is None:
+      self._specs = {k: (v.shape[1:], v.dtype) for k, v in episode.items()}
+    return {
+        k: np.empty((self._batch_size, self._length) + shape, dtype)
+        for k, (shape, dtype) in self._specs.items()}
+
+
 class DummyEnv:
 
   def __init__(self):
@@ -413,7 +997,15 @@ def args_type(default):
   return type(default)
 
 
+# How static_scan loops over time, either 'unroll' to trace a copy of the step
+# per time step or 'graph' for a tf.scan loop. Read when tracing.
+SCAN_MODE = 'unroll'
+
+
 def static_scan(fn, inputs, start, reverse=False):
+  assert SCAN_MODE in ('unroll', 'graph'), SCAN_MODE
+  if SCAN_MODE == 'graph':
+    return _graph_scan(fn, inputs, start, reverse)
   last = start
   outputs = [[] for _ in tf.nest.flatten(start)]
   indices = range(len(tf.nest.flatten(inputs)[0]))
@@ -429,6 +1021,21 @@ def static_scan(fn, inputs, start, reverse=False):
   return tf.nest.pack_sequence_as(start, outputs)
 
 
+def _graph_scan(fn, inputs, start, reverse):
+  # The first step is traced outside of the loop, because layers create their
+  # variables on the first call and a loop body cannot create variables.
+  first = -1 if reverse else 0
+  last = fn(start, tf.nest.map_structure(lambda x: x[first], inputs))
+  rest = tf.nest.map_structure(
+      lambda x: x[:-1] if reverse else x[1:], inputs)
+  outputs = tf.scan(fn, rest, last, reverse=reverse)
+  if reverse:
+    join = lambda x, y: tf.concat([x, y[None]], 0)
+  else:
+    join = lambda x, y: tf.concat([y[None], x], 0)
+  return tf.nest.map_structure(join, outputs, last)
+
+
 def _mnd_sample(self, sample_shape=(), seed=None, name='sample'):
   return tf.random.normal(
       tuple(sample_shape) + tuple(self.event_shape),
@@ -452,6 +1059,14 @@ def _cat_sample(self, sample_shape=(), seed=None, name='sample'):
 tfd.Categorical.sample = _cat_sample
 
 
+def enable_jit():
+  # XLA auto-clustering compiles the parts of every graph that it supports and
+  # leaves the rest, such as summaries and the distribution strategy, to
+  # TensorFlow. On CPU it also needs --tf_xla_cpu_global_jit in TF_XLA_FLAGS,
+  # which is only read when TensorFlow is imported, see dreamer.py.
+  tf.config.optimizer.set_jit(True)
+
+
 class Every:
 
   def __init__(self, every):
@@ -478,3 +1093,72 @@ class Once:
       self._once = False
       return True
     return False
+
+
+class TrainSchedule:
+
+  # Decides how many train steps to run after the env steps collected so far.
+  # The 'ratio' schedule owes a fixed number of train steps per env step. The
+  # 'time' schedule measures the rates of env steps and train steps and picks
+  # the ratio that spends the given fraction of the wall-clock time training,
+  # so it follows how fast collection and training run on the hardware. Owed
+  # train steps are run once there are at least `chunk` of them.
+
+  def __init__(self, mode, ratio, fraction=0.5, chunk=1, smoothing=0.1):
+    assert mode in ('ratio', 'time'), mode
+    assert 0 < fraction < 1, fraction
+    self._mode = mode
+    self._ratio = ratio
+    self._fraction = fraction
+    self._chunk = chunk
+    self._smoothing = smoothing
+    self._step = None
+    self._time = None
+    self._owed = 0.0
+    self._env_rate = None
+    self._train_rate = None
+    self._scheduled = 0
+
+  def __call__(self, step):
+    now = time.time()
+    if self._step is None:
+      self._step, self._time = step, now
+    if step > self._step:
+      # Only time spent while the step counter advances counts as collection.
+      rate = (step - self._step) / max(now - self._time, 1e-6)
+      self._env_rate = self._average(self._env_rate, rate)
+      self._owed += self.ratio * (step - self._step)
+    self._step, self._time = step, now
+    if self._owed < self._chunk:
+      return 0
+    amount = int(self._owed)
+    self._owed -= amount
+    self._scheduled += amount
+    return amount
+
+  def record(self, amount, duration):
+    # Called with the train steps run and their duration, after training.
+    if amount:
+      rate = amount / max(duration, 1e-6)
+      self._train_rate = self._average(self._train_rate, rate)
+    self._time = time.time()
+
+  @property
+  def ratio(self):
+    if self._mode == 'ratio' or not (self._env_rate and self._train_rate):
+      return self._ratio
+    odds = self._fraction / (1 - self._fraction)
+    return odds * self._train_rate / self._env_rate
+
+  def stats(self):
+    return {
+        'schedule_ratio': self.ratio,
+        'schedule_env_rate': self._env_rate or 0.0,
+        'schedule_train_rate': self._train_rate or 0.0,
+        'schedule_train_steps': self._scheduled,
+    }
+
+  def _average(self, average, value):
+    if average is None:
+      return value
+    return (1 - self._smoothing) * average + self._smoothing * value
@@ -1,6 +1,10 @@
 import atexit
+import copy
 import functools
+import importlib
+import os
 import sys
+import tempfile
 import threading
 import traceback
 
@@ -8,14 +12,43 @@ import gym
 import numpy as np
 from PIL import Image
 
-from environments.reach import FetchReachEnv
-from environments.push import FetchPushEnv
-from environments.slide import FetchSlideEnv
+
+def preload(suite, task):
+  # Import the physics libraries and compile the model of the task in the main
+  # process, so that env workers forked afterwards inherit both instead of
+  # each doing it again. The dm_control suite compiles its models inside
+  # suite.load, so only its imports are shared.
+  if suite == 'dmc':
+    importlib.import_module('dm_control.suite')
+  elif suite == 'gym':
+    from environments import robot_env
+    module = sys.modules[_fetch_env(task).__module__]
+    robot_env.load_model(module.MODEL_XML_PATH)
+
+
+def _fetch_env(name):
+  # Imported on demand, because mujoco_py is slow to import.
+  if name == "FetchReach":
+    from environments.reach import FetchReachEnv
+    return FetchReachEnv
+  elif name == "FetchSlide":
+    from environments.slide import FetchSlideEnv
+    return FetchSlideEnv
+  elif name == "FetchPush":
+    from environments.push import FetchPushEnv
+    return FetchPushEnv
+  else:
+    raise ValueError("Invalid env name " + name)
 
 
 class DeepMindControl:
 
-  def __init__(self, name, size=(64, 64), camera=None, real_world=False, sparse_reward=True, dr=None, use_state=False):
+  # Model fields that domain randomization and the tasks change per episode,
+  # e.g. for target positions, and that snapshots capture with the state.
+  _MODEL_FIELDS = ('body_mass', 'body_pos', 'geom_pos', 'site_pos')
+
+  def __init__(self, name, size=(64, 64), camera=None, real_world=False, sparse_reward=True, dr=None, use_state=False,
+               images=True, reset_pool=0):
     domain, task = name.split('_', 1)
     if domain == 'cup':  # Only domain with multiple words.
       domain = 'ball_in_cup'
@@ -32,7 +65,12 @@ class DeepMindControl:
     self.real_world = real_world
     self.sparse_reward = sparse_reward
     self.use_state = use_state
+    self.images = images  # Without images, nothing is ever rendered.
     self.dr = dr
+    # The first resets are computed and snapshotted, later ones restore one of
+    # these start states. This includes the domain randomization of the model.
+    self._reset_pool = reset_pool
+    self._starts = []
 
     self.apply_dr()
 
@@ -52,8 +90,9 @@ class DeepMindControl:
     for key, value in self._env.observation_spec().items():
       spaces[key] = gym.spaces.Box(
           -np.inf, np.inf, value.shape, dtype=np.float32)
-    spaces['image'] = gym.spaces.Box(
-        0, 255, self._size + (3,), dtype=np.uint8)
+    if self.images:
+      spaces['image'] = gym.spaces.Box(
+          0, 255, self._size + (3,), dtype=np.uint8)
     return gym.spaces.Dict(spaces)
 
   @property
@@ -61,12 +100,14 @@ class DeepMindControl:
     spec = self._env.action_spec()
     return gym.spaces.Box(spec.minimum, spec.maximum, dtype=np.float32)
 
-  def step(self, action):
+  def step(self, action, render=True):
+    # Without render, the image is left out, e.g. for intermediate repeats.
     time_step = self._env.step(action)
     obs = dict(time_step.observation)
     if self.use_state:
       obs['state'] = np.concatenate([obs['position'], obs['velocity']])  # TODO: these are specific to ball_in_cup. We should have a more general representation.  Also -- are these position and velocity of the ball or the cup?
-    obs['image'] = self.render()
+    if render:
+      self.render_obs(obs)
     reward = time_step.reward or 0
     done = time_step.last()
     info = {'discount': np.array(time_step.discount, np.float32)}
@@ -76,12 +117,18 @@ class DeepMindControl:
     return obs, reward, done, info
 
   def reset(self):
-    self.apply_dr()
-    time_step = self._env.reset()
-    obs = dict(time_step.observation)
+    if len(self._starts) < self._reset_pool or not self._reset_pool:
+      self.apply_dr()
+      time_step = self._env.reset()
+      obs = dict(time_step.observation)
+      if self._reset_pool:
+        self._starts.append(self.snapshot())
+    else:
+      self.restore(self._starts[np.random.randint(len(self._starts))])
+      obs = dict(self._env.task.get_observation(self._env.physics))
     if self.use_state:
       obs['state'] = np.concatenate([obs['position'], obs['velocity']])
-    obs['image'] = self.render()
+    self.render_obs(obs)
     obs['real_world'] = 1.0 if self.real_world else 0.0
     if self.sparse_reward:
       obs['success'] = 0.0
@@ -92,18 +139,37 @@ class DeepMindControl:
       raise ValueError("Only render mode 'rgb_array' is supported.")
     return self._env.physics.render(*self._size, camera_id=self._camera)
 
+  def render_obs(self, obs):
+    if self.images:
+      obs['image'] = self.render()
+    return obs
+
+  def snapshot(self):
+    physics = self._env.physics
+    return dict(
+        state=physics.get_state().copy(),
+        mocap_pos=physics.data.mocap_pos.copy(),
+        mocap_quat=physics.data.mocap_quat.copy(),
+        model={k: getattr(physics.model, k).copy() for k in self._MODEL_FIELDS})
+
+  def restore(self, snapshot):
+    physics = self._env.physics
+    for key, value in snapshot['model'].items():
+      getattr(physics.model, key)[:] = value
+    with physics.reset_context():
+      physics.set_state(snapshot['state'])
+      physics.data.mocap_pos[:] = snapshot['mocap_pos']
+      physics.data.mocap_quat[:] = snapshot['mocap_quat']
+    # What control.Environment.reset does besides initializing the episode.
+    self._env._reset_next_step = False
+    self._env._step_count = 0
+
 
 class GymControl:
 
-  def __init__(self, name, size=(64, 64), camera=None, dr=None):
-    if name == "FetchReach":
-      FetchEnv = FetchReachEnv
-    elif name == "FetchSlide":
-      FetchEnv = FetchSlideEnv
-    elif name == "FetchPush":
-      FetchEnv = FetchPushEnv
-    else:
-      raise ValueError("Invalid env name " + name)
+  def __init__(self, name, size=(64, 64), camera=None, dr=None, keep_pixels=True, images=True,
+               reset_pool=0):
+    FetchEnv = _fetch_env(name)
     generate_vision = True # TODO: pass in
     deterministic = False
     reward_type = "dense"
@@ -112,7 +178,13 @@ class GymControl:
     if camera is None:
       camera = "external_camera_0" # TODO: need?
     self._camera = camera
+    self._keep_pixels = keep_pixels
+    self.images = images  # Without images, nothing is ever rendered.
     self.dr = dr
+    # The first resets are computed and snapshotted, later ones restore one of
+    # these start states. This includes the domain randomization of the model.
+    self._reset_pool = reset_pool
+    self._starts = []
 
     if dr is not None:
       self._env = FetchEnv(use_vision=generate_vision, deterministic=deterministic, reward_type=reward_type,
@@ -121,6 +193,9 @@ class GymControl:
     else:
       self._env = FetchEnv(use_vision=generate_vision, deterministic=deterministic, reward_type=reward_type,
                            distance_threshold=distance_threshold, real_world=True)
+    # The Fetch env would render the same camera image into its pixels key, so
+    # render once here and optionally keep the pixels key as a copy of it.
+    self._env.render_pixels = False
 
   def apply_dr(self):
     if self.dr is None:
@@ -136,8 +211,12 @@ class GymControl:
     for key, value in self._env.observation_space.items():
       spaces[key] = gym.spaces.Box(
           -np.inf, np.inf, value.shape, dtype=np.float32)
-    spaces['image'] = gym.spaces.Box(
-        0, 255, self._size + (3,), dtype=np.uint8)
+    spaces.pop('pixels', None)
+    if self.images:
+      spaces['image'] = gym.spaces.Box(
+          0, 255, self._size + (3,), dtype=np.uint8)
+      if self._keep_pixels and self._env.use_vision:
+        spaces['pixels'] = spaces['image']
     return gym.spaces.Dict(spaces)
 
   @property
@@ -146,30 +225,64 @@ class GymControl:
     # return gym.spaces.Box(spec.minimum, spec.maximum, dtype=np.float32)
     return self._env.action_space
 
-  def step(self, action):
+  def step(self, action, render=True):
     # time_step = self._env.step(action)
     # obs = dict(time_step.observation)
     obs, reward, done, info = self._env.step(action) # Done currently has None
-    img = self.render()
-    obs['image'] = img
+    if render:
+      self.render_obs(obs)
     done = int(done) # int(self._env._is_success(obs["achieved_goal"], obs["desired_goal"]))
     discount = 1 # TODO: discount?
     info = {'discount': np.array(discount, np.float32)}
     return obs, reward, done, info
 
   def reset(self):
-    self.apply_dr()
-    obs = self._env.reset()
+    if len(self._starts) < self._reset_pool or not self._reset_pool:
+      self.apply_dr()
+      obs = self._env.reset()
+      if self._reset_pool:
+        self._starts.append(self.snapshot())
+    else:
+      obs = self.restore(self._starts[np.random.randint(len(self._starts))])
     # time_step = self._env.reset()
     # obs = dict(time_step.observation)
-    obs['image'] = self.render()
-    return obs
+    return self.render_obs(obs)
 
   def render(self, *args, **kwargs):
     if kwargs.get('mode', 'rgb_array') != 'rgb_array':
       raise ValueError("Only render mode 'rgb_array' is supported.")
     width, height = self._size
-    return self._env.sim.render(width=width, height=height, camera_name=self._camera)[::-1]
+    return self._env.render_image(width, height, self._camera)
+
+  def render_obs(self, obs):
+    if not self.images:
+      return obs
+    obs['image'] = self.render()
+    if self._keep_pixels and self._env.use_vision:
+      obs['pixels'] = obs['image']
+    return obs
+
+  def snapshot(self):
+    sim = self._env.sim
+    return dict(
+        state=copy.deepcopy(sim.get_state()),
+        mocap_pos=sim.data.mocap_pos.copy(),
+        mocap_quat=sim.data.mocap_quat.copy(),
+        goal=self._env.goal.copy(),
+        body_mass=sim.model.body_mass.copy())
+
+  def restore(self, snapshot):
+    # Restores a start state and returns its observation, like reset.
+    env = self._env
+    env.sim.model.body_mass[:] = snapshot['body_mass']
+    env.sim.set_state(snapshot['state'])
+    env.sim.data.mocap_pos[:] = snapshot['mocap_pos']
+    env.sim.data.mocap_quat[:] = snapshot['mocap_quat']
+    env.sim.forward()
+    env.goal = snapshot['goal'].copy()
+    env.reach_obj = -1
+    env._state_id += 1
+    return env._get_obs()
 
 
 class Atari:
@@ -264,21 +377,25 @@ class Collect:
     self._callbacks = callbacks or ()
     self._precision = precision
     self._episode = None
+    self._length = 0
+    self._capacity = 64
 
   def __getattr__(self, name):
     return getattr(self._env, name)
 
   def step(self, action):
-    obs, reward, done, info = self._env.step(action)
+    return self._record(action, *self._env.step(action))
+
+  def _record(self, action, obs, reward, done, info):
     obs = {k: self._convert(v) for k, v in obs.items()}
     transition = obs.copy()
     transition['action'] = action
     transition['reward'] = reward
     transition['discount'] = info.get('discount', np.array(1 - float(done)))
-    self._episode.append(transition)
+    self._append(transition)
     if done:
-      episode = {k: [t[k] for t in self._episode] for k in self._episode[0]}
-      episode = {k: self._convert(v) for k, v in episode.items()}
+      episode = {k: v[:self._length] for k, v in self._episode.items()}
+      self._capacity = self._length
       info['episode'] = episode
       for callback in self._callbacks:
         callback(episode)
@@ -290,20 +407,117 @@ class Collect:
     transition['action'] = np.zeros(self._env.action_space.shape)
     transition['reward'] = 0.0
     transition['discount'] = 1.0
-    self._episode = [transition]
+    # Finished episodes are handed to the callbacks as views of the columns,
+    # so every episode gets new columns, sized like the previous episode.
+    transition = {k: self._convert(v) for k, v in transition.items()}
+    self._episode = {
+        k: np.empty((self._capacity,) + v.shape, v.dtype)
+        for k, v in transition.items()}
+    self._length = 0
+    self._append(transition)
     return obs
 
+  def close(self):
+    # Callbacks such as background episode writers flush on close.
+    for callback in self._callbacks:
+      if hasattr(callback, 'close'):
+        callback.close()
+    if hasattr(self._env, 'close'):
+      return self._env.close()
+
+  def _append(self, transition):
+    if self._length == len(self._episode['reward']):
+      self._episode = {
+          k: np.concatenate([v, np.empty_like(v)])
+          for k, v in self._episode.items()}
+    for key, column in self._episode.items():
+      value = np.asarray(transition[key])
+      if value.dtype != column.dtype:
+        # Columns take their dtype from the reset transition, so promote them
+        # when a later value needs a wider type, e.g. a float after an int.
+        dtype = self._dtype(np.result_type(column.dtype, value.dtype))
+        if dtype != column.dtype:
+          column = self._episode[key] = column.astype(dtype)
+      column[self._length] = value
+    self._length += 1
+
   def _convert(self, value):
     value = np.array(value)
-    if np.issubdtype(value.dtype, np.floating):
-      dtype = {16: np.float16, 32: np.float32, 64: np.float64}[self._precision]
-    elif np.issubdtype(value.dtype, np.signedinteger):
-      dtype = {16: np.int16, 32: np.int32, 64: np.int64}[self._precision]
-    elif np.issubdtype(value.dtype, np.uint8):
-      dtype = np.uint8
+    return value.astype(self._dtype(value.dtype))
+
+  def _dtype(self, dtype):
+    if np.issubdtype(dtype, np.floating):
+      return {16: np.float16, 32: np.float32, 64: np.float64}[self._precision]
+    elif np.issubdtype(dtype, np.signedinteger):
+      return {16: np.int16, 32: np.int32, 64: np.int64}[self._precision]
+    elif np.issubdtype(dtype, np.uint8):
+      return np.uint8
     else:
-      raise NotImplementedError(value.dtype)
-    return value.astype(dtype)
+      raise NotImplementedError(dtype)
+
+
+class FusedControl(Collect):
+
+  # The same as RewardObs(Collect(TimeLimit(NormalizeActions(ActionRepeat(env)))))
+  # for control suites, but a step is one flat method without the attribute
+  # proxies of the stack and with the action scaling precomputed.
+
+  def __init__(self, env, amount, duration, callbacks=None, precision=32):
+    super().__init__(env, callbacks, precision)
+    self._amount = amount
+    self._duration = duration
+    self._step = None
+    space = env.action_space
+    self._mask = np.logical_and(np.isfinite(space.low), np.isfinite(space.high))
+    self._low = np.where(self._mask, space.low, -1)
+    self._high = np.where(self._mask, space.high, 1)
+    # Halving is exact, so this matches NormalizeActions bit for bit.
+    self._scale = (self._high - self._low) / 2
+    self._bounded = self._mask.all()
+
+  @property
+  def observation_space(self):
+    spaces = self._env.observation_space.spaces
+    assert 'reward' not in spaces
+    spaces['reward'] = gym.spaces.Box(-np.inf, np.inf, dtype=np.float32)
+    return gym.spaces.Dict(spaces)
+
+  @property
+  def action_space(self):
+    low = np.where(self._mask, -np.ones_like(self._low), self._low)
+    high = np.where(self._mask, np.ones_like(self._low), self._high)
+    return gym.spaces.Box(low, high, dtype=np.float32)
+
+  def step(self, action):
+    assert self._step is not None, 'Must reset environment.'
+    original = (action + 1) * self._scale + self._low
+    if not self._bounded:
+      original = np.where(self._mask, original, action)
+    done = False
+    total_reward = 0
+    current_step = 0
+    while current_step < self._amount and not done:
+      render = current_step == self._amount - 1
+      obs, reward, done, info = self._env.step(original, render=render)
+      total_reward += reward
+      current_step += 1
+    if 'image' not in obs:
+      self._env.render_obs(obs)
+    self._step += 1
+    if self._step >= self._duration:
+      done = True
+      if 'discount' not in info:
+        info['discount'] = np.array(1.0).astype(np.float32)
+      self._step = None
+    obs, reward, done, info = self._record(action, obs, total_reward, done, info)
+    obs['reward'] = reward
+    return obs, reward, done, info
+
+  def reset(self):
+    self._step = 0
+    obs = super().reset()
+    obs['reward'] = 0.0
+    return obs
 
 
 class TimeLimit:
@@ -342,13 +556,19 @@ class ActionRepeat:
     return getattr(self._env, name)
 
   def step(self, action):
+    # Only the observation of the last sub-step is returned, so the inner env
+    # skips rendering before that. If the episode ends early, the final state
+    # is rendered afterwards.
     done = False
     total_reward = 0
     current_step = 0
     while current_step < self._amount and not done:
-      obs, reward, done, info = self._env.step(action)
+      render = current_step == self._amount - 1
+      obs, reward, done, info = self._env.step(action, render=render)
       total_reward += reward
       current_step += 1
+    if 'image' not in obs:
+      self._env.render_obs(obs)
     return obs, total_reward, done, info
 
 
@@ -467,6 +687,107 @@ class RewardObs:
     return obs
 
 
+class Batch:
+
+  # Several environments behind one interface, so that a single Async worker
+  # steps all of them per message. Actions, observations, rewards and dones are
+  # stacked along the first axis and reset takes the indices to reset.
+
+  def __init__(self, envs):
+    self._envs = envs
+
+  def __getattr__(self, name):
+    return getattr(self._envs[0], name)
+
+  @property
+  def num_envs(self):
+    return len(self._envs)
+
+  @property
+  def observation_space(self):
+    spaces = {}
+    for key, value in self._envs[0].observation_space.spaces.items():
+      low = np.repeat(value.low[None], len(self._envs), 0)
+      high = np.repeat(value.high[None], len(self._envs), 0)
+      spaces[key] = gym.spaces.Box(low, high, dtype=value.dtype)
+    return gym.spaces.Dict(spaces)
+
+  def step(self, actions):
+    results = [env.step(a) for env, a in zip(self._envs, actions)]
+    obs, rewards, dones, infos = zip(*results)
+    obs = {k: np.stack([o[k] for o in obs]) for k in obs[0]}
+    return obs, np.array(rewards), np.array(dones), list(infos)
+
+  def reset(self, indices=None):
+    if indices is None:
+      indices = range(len(self._envs))
+    obs = [self._envs[index].reset() for index in indices]
+    return {k: np.stack([o[k] for o in obs]) for k in obs[0]}
+
+  def close(self):
+    for env in self._envs:
+      if hasattr(env, 'close'):
+        env.close()
+
+
+class SharedObs:
+
+  # Ring of observation slots in a shared memory file. The worker copies the
+  # arrays of each observation that match the observation space into the next
+  # slot and only the slot index and the remaining small values are pickled.
+  # Slots are reused after `slots` observations, so the reader has to copy an
+  # observation out before that many newer ones have been written.
+
+  def __init__(self, layout):
+    self.layout = layout
+    path, slots, fields = layout
+    self._path = path
+    self._slots = slots
+    self._next = 0
+    self._arrays = {
+        key: np.memmap(path, dtype, 'r+', offset, (slots,) + shape)
+        for key, shape, dtype, offset in fields}
+
+  @classmethod
+  def create(cls, space, slots):
+    fields, offset = [], 0
+    for key, box in space.spaces.items():
+      dtype = np.dtype(box.dtype)
+      fields.append((key, tuple(box.shape), dtype.str, offset))
+      size = slots * int(np.prod(box.shape)) * dtype.itemsize
+      offset += -(-size // 64) * 64
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    fd, path = tempfile.mkstemp(prefix='obs-', dir=directory)
+    os.ftruncate(fd, max(offset, 1))
+    os.close(fd)
+    return cls((path, slots, fields))
+
+  def write(self, obs):
+    slot = self._next
+    self._next = (self._next + 1) % self._slots
+    rest = {}
+    for key, value in obs.items():
+      array = self._arrays.get(key)
+      if (array is not None and isinstance(value, np.ndarray) and
+          value.shape == array.shape[1:] and value.dtype == array.dtype):
+        array[slot] = value
+      else:
+        rest[key] = value
+    return slot, list(obs.keys()), rest
+
+  def read(self, slot, keys, rest):
+    return {
+        k: rest[k] if k in rest else np.array(self._arrays[k][slot])
+        for k in keys}
+
+  def unlink(self):
+    # Both processes keep their mapping after the file is removed.
+    try:
+      os.unlink(self._path)
+    except FileNotFoundError:
+      pass
+
+
 class Async:
 
   _ACCESS = 1
@@ -474,20 +795,38 @@ class Async:
   _RESULT = 3
   _EXCEPTION = 4
   _CLOSE = 5
+  _SHARED = 6
+
+  _SLOTS = 16
 
-  def __init__(self, ctor, strategy='process'):
+  def __init__(self, ctor, strategy='process', transport='pipe'):
+    # With the shm transport, process workers return the observations of step
+    # and reset through shared memory rather than pickling them.
+    assert transport in ('pipe', 'shm'), transport
     self._strategy = strategy
+    self._shared = None
+    # Every request carries an id, so several can be outstanding and their
+    # promises can be resolved in any order. Results that arrive before their
+    # promise is called are kept until then.
+    self._next_request = 0
+    self._pending = set()
+    self._results = {}
     if strategy == 'none':
       self._env = ctor()
     elif strategy == 'thread':
       import multiprocessing.dummy as mp
     elif strategy == 'process':
-      import multiprocessing as mp
+      # Forked workers start with the imports and preloaded models of the
+      # main process, see preload(), on every platform.
+      import multiprocessing
+      mp = multiprocessing.get_context('fork')
     else:
       raise NotImplementedError(strategy)
     if strategy != 'none':
       self._conn, conn = mp.Pipe()
-      self._process = mp.Process(target=self._worker, args=(ctor, conn))
+      shared = transport == 'shm' and strategy == 'process'
+      self._process = mp.Process(
+          target=self._worker, args=(ctor, conn, shared))
       atexit.register(self.close)
       self._process.start()
     self._obs_space = None
@@ -505,19 +844,21 @@ class Async:
       self._action_space = self.__getattr__('action_space')
     return self._action_space
 
+  @property
+  def connection(self):
+    # Readable once a result is available, for multiprocessing.connection.wait.
+    return self._conn if self._strategy == 'process' else None
+
   def __getattr__(self, name):
     if self._strategy == 'none':
       return getattr(self._env, name)
-    self._conn.send((self._ACCESS, name))
-    return self._receive()
+    return self._request(self._ACCESS, name)()
 
   def call(self, name, *args, **kwargs):
     blocking = kwargs.pop('blocking', True)
     if self._strategy == 'none':
       return functools.partial(getattr(self._env, name), *args, **kwargs)
-    payload = name, args, kwargs
-    self._conn.send((self._CALL, payload))
-    promise = self._receive
+    promise = self._request(self._CALL, (name, args, kwargs))
     return promise() if blocking else promise
 
   def close(self):
@@ -528,7 +869,7 @@ class Async:
         pass
       return
     try:
-      self._conn.send((self._CLOSE, None))
+      self._conn.send((self._CLOSE, None, None))
       self._conn.close()
     except IOError:
       # The connection was already closed.
@@ -538,49 +879,97 @@ class Async:
   def step(self, action, blocking=True):
     return self.call('step', action, blocking=blocking)
 
-  def reset(self, blocking=True):
-    return self.call('reset', blocking=blocking)
-
-  def _receive(self):
+  def reset(self, *args, blocking=True):
+    return self.call('reset', *args, blocking=blocking)
+
+  def _request(self, message, payload):
+    # Results are fetched before too many requests are outstanding. This keeps
+    # shared memory slots from being reused before they are read and the pipe
+    # from filling up in both directions.
+    while len(self._pending) >= self._SLOTS:
+      self._fetch()
+    request = self._next_request
+    self._next_request += 1
+    self._conn.send((message, request, payload))
+    self._pending.add(request)
+    return functools.partial(self._receive, request)
+
+  def _receive(self, request):
+    while request not in self._results:
+      self._fetch()
+    return self._results.pop(request)
+
+  def _fetch(self):
     try:
-      message, payload = self._conn.recv()
+      message, request, payload = self._conn.recv()
     except ConnectionResetError:
       raise RuntimeError('Environment worker crashed.')
     # Re-raise exceptions in the main process.
     if message == self._EXCEPTION:
       stacktrace = payload
       raise Exception(stacktrace)
-    if message == self._RESULT:
-      return payload
-    raise KeyError(f'Received message of unexpected type {message}')
-
-  def _worker(self, ctor, conn):
+    if message == self._SHARED:
+      layout, header, rest = payload
+      if layout:
+        self._shared = SharedObs(layout)
+        self._shared.unlink()
+      obs = self._shared.read(*header)
+      payload = obs if rest is None else (obs,) + rest
+    elif message != self._RESULT:
+      raise KeyError(f'Received message of unexpected type {message}')
+    self._pending.remove(request)
+    self._results[request] = payload
+
+  def _worker(self, ctor, conn, shared=False):
+    ring = None
     try:
       env = ctor()
       while True:
         try:
-          # Only block for short times to have keyboard exceptions be raised.
-          if not conn.poll(0.1):
-            continue
-          message, payload = conn.recv()
+          # Block until the next request, the parent sends a close message or
+          # closes its end of the pipe.
+          message, request, payload = conn.recv()
         except (EOFError, KeyboardInterrupt):
           break
         if message == self._ACCESS:
           name = payload
           result = getattr(env, name)
-          conn.send((self._RESULT, result))
+          conn.send((self._RESULT, request, result))
           continue
         if message == self._CALL:
           name, args, kwargs = payload
           result = getattr(env, name)(*args, **kwargs)
-          conn.send((self._RESULT, result))
+          if shared and name in ('step', 'reset'):
+            layout = None
+            if ring is None:
+              ring = SharedObs.create(env.observation_space, self._SLOTS)
+              layout = ring.layout
+            if name == 'reset':
+              obs, rest = result, None
+            else:
+              obs, reward, done, info = result
+              # The collected episode is only needed by the env callbacks.
+              strip = lambda x: {k: v for k, v in x.items() if k != 'episode'}
+              info = strip(info) if isinstance(info, dict) else (
+                  [strip(x) for x in info])
+              rest = reward, done, info
+            payload = layout, ring.write(obs), rest
+            conn.send((self._SHARED, request, payload))
+            continue
+          conn.send((self._RESULT, request, result))
           continue
         if message == self._CLOSE:
           assert payload is None
           break
         raise KeyError(f'Received message of unknown type {message}')
+      try:
+        env.close()
+      except AttributeError:
+        pass
     except Exception:
       stacktrace = ''.join(traceback.format_exception(*sys.exc_info()))
       print(f'Error in environment process: {stacktrace}')
-      conn.send((self._EXCEPTION, stacktrace))
+      conn.send((self._EXCEPTION, None, stacktrace))
+    if ring:
+      ring.unlink()
     conn.close()